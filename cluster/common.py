@@ -1,11 +1,17 @@
 import json
+import mmap
 import os
 import sys
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from operator import attrgetter
+from xml.etree.ElementTree import ParseError
 
-from cluster.config import RE_JOB, UP_STATES, USER, LOG_PATH, PBS_OUTPUT, RE_DC, CLUSTER_NAME
-from cluster.tools import read_xml, generic_to_gb, parse_xml, cache_cmd, run_cmd
+from cluster.config import RE_JOB, UP_STATES, USER, LOG_PATH, PBS_OUTPUT, RE_DC, CLUSTER_NAME, \
+    RE_PBS_HEADER, RE_PBS_RESOURCE, RE_PBS_LOG, PBS_OUTPUT_CACHE, PBS_OUTPUT_WORKERS, \
+    PBS_OUTPUT_MMAP_SIZE
+from cluster.tools import generic_to_gb, iter_xml, cache_cmd, parse_isoformat, reversed_lines, \
+    read_pickle, write_pickle, CommandError, finditer_lines
 
 
 class Node:
@@ -20,16 +26,16 @@ class Node:
         :type nodeele: Et.Element
         """
         self.raw = node
-        status = dict([kv.split('=') for kv in node['status'].split(',')]) if 'status' in node else {}
+        status = dict(kv.split('=', 1) for kv in node['status'].split(',')) if 'status' in node else {}
 
-        self.name = node['name'].split('.')[0]
-        jobs = [RE_JOB.match(j).group(2) for j in node.get('jobs', '').split(',') if RE_JOB.match(j)]
+        self.name = node['name'].partition('.')[0]
+        jobs = [m.group(2) for m in map(RE_JOB.match, node.get('jobs', '').split(',')) if m]
         self.jobs_node = set(jobs)
 
         self.cpu_all = int(node.get('np', '0'))
         self.cpu_res = int(node.get('np_assigned', len(jobs)))
 
-        self.mem_all = int(status.get('physmem', '0kb')[:-2]) / 1024. / 1024.
+        self.mem_all = generic_to_gb(status.get('physmem', '0kb'))  # Torque reports kb, PBS Pro mem can be any unit
         self.load = status.get('loadave', '0')
 
         self.states = node.get('state', 'N/A')
@@ -46,7 +52,14 @@ class Node:
         """
         self.jobs_qstat = [j for j in jobs.values() if j.node == self.name]
         self.mem_res = sum([j.mem for j in self.jobs_qstat])
-        self.orphans = [jobs[j] for j in self.jobs_node if not jobs[j].node]
+        self.orphans = []
+        for job_id in self.jobs_node:
+            job = jobs.get(job_id)
+            if job is None:  # Running here but not listed by qstat
+                job = Job()
+                job.job_id = int(job_id)
+            if not job.node:
+                self.orphans.append(job)
         return self
 
 
@@ -76,13 +89,13 @@ class Job:
         :param job: Job details from qstat
         :type job: dict
         """
-        self.job_id = int(job['Job_Id'].split('.')[0])
+        self.job_id = int(job['Job_Id'].partition('.')[0])
         self.user = job['euser']
         if 'Resource_List.mem' in job:
             self.mem = generic_to_gb(job['Resource_List.mem'])
 
         if job.get('exec_host'):
-            self.node = job['exec_host'].split('/')[0].split('.')[0]
+            self.node = job['exec_host'].partition('/')[0].partition('.')[0]
 
         self.state = job.get('job_state', self.state)
         if 'queue' in job:
@@ -93,8 +106,11 @@ class Job:
 
         self.name = job.get('Job_Name', self.name)
 
-        used_mem = generic_to_gb(job.get('resources_used.mem', '0gb'))
-        self.memory = '%.1f/%.1fG (%3d%%)' % (used_mem, self.mem, used_mem / self.mem * 100)
+        used_mem = generic_to_gb(job['resources_used.mem']) if 'resources_used.mem' in job else 0.
+        if self.mem:
+            self.memory = '%.1f/%.1fG (%3d%%)' % (used_mem, self.mem, used_mem / self.mem * 100)
+        else:  # Requested 0gb, nothing to show usage relative to
+            self.memory = '%.1f/%.1fG' % (used_mem, self.mem)
         self.qstat = True
 
         if 'stime' in job:
@@ -162,54 +178,82 @@ class Job:
 
 
 class Cluster:
-    jobs = defaultdict(Job)
-    nodes = []
-
     def __init__(self, nodes=False, link=False, jobs_qstat=False, jobs_log=False, jobs_pbs=False, cached=True,
-                 own=False):
+                 own=False, log_since=None):
         """
 
         :param jobs_qstat: Load jobs from qstat
         :param nodes: Load nodes
         :param link: Link jobs to nodes
+        :param log_since: Read only .pbs_log entries of jobs submitted or finished after this time
         :type jobs_qstat: bool
         :type nodes: bool
         :type link: bool
+        :type log_since: datetime
         """
         self.cached = cached
+        self.jobs = {}
+        self.nodes = []
+        self.pbs_log_other = []  # .pbs_log lines not parsed into any job, malformed or from another cluster
 
         if not own and (jobs_log or jobs_pbs):  # Restrict reading only own jobs if parsing also log or pbs
             own = True
 
-        if nodes:
-            self.load_nodes()
+        # qstat is mostly waiting on the PBS server, run it while we query pbsnodes and read the output files in home
+        # folder. Jobs are still parsed in the main thread and in the same order, qstat first, output files override
+        # its state.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            qstat = executor.submit(self.fetch_qstat) if jobs_qstat else None
 
-        if jobs_qstat:
-            try:
-                self.read_qstatj(not own)
-            except Exception:  # There is no JSON format option
-                self.read_qstatx(not own)
+            if nodes:
+                self.load_nodes()
 
-        if jobs_log:
-            self.read_pbs_log()
+            outputs = self.load_pbs_output() if jobs_pbs else None
 
+            if qstat is not None:
+                qstat_format, qstat_output = qstat.result()
+                if qstat_format == 'json':
+                    try:
+                        self.read_qstatj(not own, qstat_output)
+                    except Exception:  # Broken JSON output
+                        self.read_qstatx(not own)
+                else:
+                    self.read_qstatx(not own, qstat_output)
+
+        # Read outputs before the log, finished jobs tell read_pbs_log how far back it has to go
         if jobs_pbs:
-            self.read_pbs_output()
+            self.read_pbs_output(outputs)
+
+        if jobs_log:
+            self.read_pbs_log(log_since)
 
         if link:
             self.link_jobs_to_nodes()
 
-    def read_qstatj(self, read_all):
+    def fetch_qstat(self):
+        """ Run qstat with JSON output, or XML output where qstat doesn't support -F json
+
+        :return: Output format ("json" or "xml") and qstat output
+        :rtype: tuple[str, str]
+        """
+        try:
+            return 'json', cache_cmd(['/usr/bin/qstat', '-f', '-F', 'json'], ignore_cache=not self.cached)
+        except Exception:  # There is no JSON format option
+            return 'xml', cache_cmd(['/usr/bin/qstat', '-x'], ignore_cache=not self.cached)
+
+    def read_qstatj(self, read_all, qstat=None):
         """Parse qstat -f -F json output to get the most details about queued/running jobs of the user that executes
         this script. Returns job_id -> job_details pairs. There are too many job_details keys to list here, the most
         useful ones are: resources_used.walltime, Resource_List.walltime, resources_used.mem, Resource_List.mem, ...
         This is the JSON parsing version. Should be a bit safer than parsing regular output with RE.
         """
-        job_json = json.loads(cache_cmd('/usr/bin/qstat -f -F json', ignore_cache=not self.cached)).get('Jobs', {})
+        if qstat is None:
+            qstat = cache_cmd(['/usr/bin/qstat', '-f', '-F', 'json'], ignore_cache=not self.cached)
+        job_json = json.loads(qstat).get('Jobs', {})
 
         for jobid, job in job_json.items():
-            job['Job_Id'] = jobid.split('.')[0]
-            job['euser'] = job['Job_Owner'].split('@')[0]
+            job['Job_Id'] = jobid.partition('.')[0]
+            job['euser'] = job['Job_Owner'].partition('@')[0]
 
             if read_all or job.get('euser') == USER:
                 for ts in ['qtime', 'mtime', 'ctime', 'etime', 'stime']:
@@ -225,57 +269,99 @@ class Cluster:
                     for resource, res_value in job['resources_used'].items():
                         job['resources_used.%s' % resource] = res_value
 
-                self.jobs[job['Job_Id']].parse_qstat(job)
+                self.get_job(job['Job_Id']).parse_qstat(job)
 
-    def read_qstatx(self, read_all):
+    def read_qstatx(self, read_all, qstat=None):
         """Parse qstat -x output to get the most details about queued/running jobs of the user that executes this
         script. Returns job_id -> job_details pairs. There are too many job_details keys to list here, the most useful
         ones are: resources_used.walltime, Resource_List.walltime, resources_used.mem, Resource_List.mem, ...
         This is the XML parsing version. Should be a bit safer than parsing regular output with RE.
         """
-        for jobele in parse_xml(cache_cmd('/usr/bin/qstat -x', ignore_cache=not self.cached)):
-            job = dict([(attr.tag, attr.text) for attr in jobele])
-            job['Job_Id'] = job['Job_Id'].split('.')[0]
+        if qstat is None:
+            qstat = cache_cmd(['/usr/bin/qstat', '-x'], ignore_cache=not self.cached)
 
-            if read_all or job.get('euser') == USER:
-                for ts in ['qtime', 'mtime', 'ctime', 'etime']:
-                    if ts in job:
-                        job[ts] = datetime.fromtimestamp(int(job[ts]))
+        # Stream the jobs, the full qstat -x tree of a busy cluster is big and we keep only a fraction of it
+        for jobele in iter_xml(qstat, 'Job'):
+            # Most jobs on a shared cluster belong to other users, skip them before doing any parsing work
+            if not read_all and jobele.findtext('euser') != USER:
+                continue
 
-                if 'Resource_List' in job:
-                    job.pop('Resource_List')
-                    for rl in jobele.find('Resource_List'):
-                        job['Resource_List.%s' % rl.tag] = rl.text
+            job = dict((attr.tag, attr.text) for attr in jobele)
+            job['Job_Id'] = job['Job_Id'].partition('.')[0]
 
-                if 'resources_used' in job:
-                    job.pop('resources_used')
-                    for rl in jobele.find('resources_used'):
-                        job['resources_used.%s' % rl.tag] = rl.text
+            for ts in ['qtime', 'mtime', 'ctime', 'etime']:
+                if ts in job:
+                    job[ts] = datetime.fromtimestamp(int(job[ts]))
+
+            if 'Resource_List' in job:
+                job.pop('Resource_List')
+                for rl in jobele.find('Resource_List'):
+                    job['Resource_List.%s' % rl.tag] = rl.text
 
-                self.jobs[job['Job_Id']].parse_qstat(job)
+            if 'resources_used' in job:
+                job.pop('resources_used')
+                for rl in jobele.find('resources_used'):
+                    job['resources_used.%s' % rl.tag] = rl.text
 
-    def read_pbs_log(self):
+            self.get_job(job['Job_Id']).parse_qstat(job)
+
+    def read_pbs_log(self, since=None):
         """Parse .pbs_log file created by the new submitjob script for some extra info on running/finished jobs. Returns
         job_id -> (timestamp, command) pairs.
+
+        :param since: Read only entries of jobs submitted or finished after this time, the log is then read backwards
+        :type since: datetime
         """
-        if os.path.isfile(LOG_PATH):
+        if not os.path.isfile(LOG_PATH):
+            return
+
+        if since is None:
+            # Slurp the log in one read and let a single regex scan split it into entries, it's a lot faster than
+            # splitting and tokenizing every line in python when the log gets long
             with open(LOG_PATH) as log:
-                for log_line in log:
-                    timestamp, job_id, cmd = log_line.strip().split(None, 2)
+                entries = finditer_lines(RE_PBS_LOG, log.read())
+        else:
+            entries = ((RE_PBS_LOG.match(line), line) for line in reversed_lines(LOG_PATH))
 
-                    if CLUSTER_NAME not in job_id:
-                        continue
+            # Jobs that finished after the cutoff need their log entry even if they were submitted before it
+            finished_ids = [job.job_id for job in self.jobs.values() if job.finished and job.finished >= since]
+            min_job_id = min(finished_ids) if finished_ids else None
 
-                    job_id = job_id.split('.')[0]
-                    try:
-                        start_time = datetime.strptime(timestamp, "[%Y-%m-%dT%H:%M:%S.%f]")
-                    except ValueError:
-                        start_time = datetime.strptime(timestamp, "[%Y-%m-%dT%H:%M:%S]")
+        for entry, line in entries:
+            if entry is None:
+                if line.strip():  # Malformed line, keep it so archive can write it back
+                    self.pbs_log_other.append(line + '\n')
+                continue
+
+            timestamp, job_id, cmd = entry.groups()
+
+            if CLUSTER_NAME not in job_id:
+                self.pbs_log_other.append(entry.group(0) + '\n')
+                continue
 
-                    self.jobs[job_id].parse_pbs_log(job_id, start_time, cmd, log_line)
+            job_id = job_id.partition('.')[0]
+            start_time = parse_isoformat(timestamp)
 
-    def read_pbs_output(self):
-        """Parse all job output files in ~/pbs-output/ folder and return the details as a job_id -> job_details pairs.
+            # Job IDs grow with submission time, nothing older than this entry can be relevant anymore
+            if since is not None and start_time < since and (min_job_id is None or int(job_id) < min_job_id):
+                break
+
+            self.get_job(job_id).parse_pbs_log(job_id, start_time, cmd, entry.group(0) + '\n')
+
+    def read_pbs_output(self, outputs=None):
+        """Add job details from output files in ~/pbs-output/ folder to the jobs.
+
+        :param outputs: Job details as returned by load_pbs_output, loaded now if not given
+        :type outputs: list[dict]
+        """
+        if outputs is None:
+            outputs = self.load_pbs_output()
+
+        for out_data in outputs:
+            self.get_job(out_data['job_id']).parse_pbs_output(out_data)
+
+    def load_pbs_output(self):
+        """Parse all job output files in ~/pbs-output/ folder and return the details as a list of job_details.
         Known job_details keys are:
         1. "Run command"
         2. "Execution host"
@@ -287,56 +373,78 @@ class Cluster:
         4.4 "vmem"
         TODO: parse contents only if the job is displayed or filtered
         """
-        output_files = os.listdir(PBS_OUTPUT)
+        # scandir gets the names in one pass and gives us full paths and stat results without extra joins
+        output_files = list(os.scandir(PBS_OUTPUT))
         if len(output_files) > 1000:
             sys.stderr.write("WARNING: pbs-output folder contains %d files which will make jobstatus details slow. "
                              "We suggest archiving old jobs using 'jobstatus archive' command. See jobstatus archive "
                              "--help to find out how to use it.\n" % (len(output_files),))
 
-        for out in output_files:
+        output_suffix = '%s.OU' % CLUSTER_NAME
+        cache = read_pickle(PBS_OUTPUT_CACHE, {})
+        new_cache = {}
+        outputs = []
+        missing = []
+
+        for entry in output_files:
+            out = entry.name
             name = ''
 
             # Parse only job files ending with:
-            if out.endswith('%s.OU' % CLUSTER_NAME):  # Read only output for this cluster, if home folder is shared
-                job_id = out.split('.')[0]
-            elif RE_DC.match(out):  # new DC cluster format... ie: python.o70
-                matcher = RE_DC.match(out)
-                name = matcher.group(1)
-                job_id = matcher.group(2)
+            if out.endswith(output_suffix):  # Read only output for this cluster, if home folder is shared
+                job_id = out.partition('.')[0]
             else:
-                continue
-
+                matcher = RE_DC.match(out)  # new DC cluster format... ie: python.o70
+                if not matcher:
+                    continue
+                name, job_id = matcher.groups()
+
+            # Output files are written once the job finishes, same inode, ctime and size mean we parsed it already
+            stat = entry.stat()
+            key = (entry.inode(), stat.st_ctime, stat.st_size)
+            cached = cache.get(out)
+            if cached is not None and cached[0] == key:
+                new_cache[out] = cached
+            else:
+                missing.append((out, key, entry.path))
+            outputs.append((out, job_id, name, stat.st_ctime, entry.path))
+
+        # Files are independent and reading them is mostly waiting on the (often network) home folder
+        if missing:
+            with ThreadPoolExecutor(max_workers=PBS_OUTPUT_WORKERS) as executor:
+                parsed = executor.map(read_pbs_output_file, [path for _, _, path in missing])
+                for (out, key, _), headers in zip(missing, parsed):
+                    new_cache[out] = (key, headers)
+
+        details = []
+        for out, job_id, name, ctime, path in outputs:
             # Set ctime of the output file as execution end time
             out_data = {
                 'job_id': job_id,
-                'finished': datetime.fromtimestamp(os.path.getctime(os.path.join(PBS_OUTPUT, out))),
-                'pbs_output': os.path.join(PBS_OUTPUT, out),
+                'finished': datetime.fromtimestamp(ctime),
+                'pbs_output': path,
                 'name': name}
+            out_data.update(new_cache[out][1])
+            details.append(out_data)
 
-            with open(os.path.join(PBS_OUTPUT, out)) as fin:
-                for line in fin:
-                    if line.startswith('==>'):  # Parse only useful details, ignore job output for now
-                        param, val = line[4:].strip().split(':', 1)
-                        param = param.strip()
+        # Store only files that still exist, archived outputs drop out of the cache
+        if missing or len(new_cache) != len(cache):
+            write_pickle(PBS_OUTPUT_CACHE, new_cache)
 
-                        if param == 'Resources used':
-                            out_data.update([v.split('=') for v in val.strip().split(',')])
-                        elif param == 'Job config':
-                            out_data.update([v.split('=') for v in val.strip().split(',')])
-                        else:
-                            out_data[param] = val.strip()
-
-            self.jobs[job_id].parse_pbs_output(out_data)
+        return details
 
     def load_nodes(self):
         """ Parse pbsnodes -x output to get node details.
         """
         self.nodes = []
         try:
-            for nodeele in read_xml('pbsnodes -x'):
-                self.nodes.append(Node(dict([(attr.tag, attr.text) for attr in nodeele]))) # python 2.6 compat
-        except:
-            nodes_json = json.loads(run_cmd('pbsnodes -a -F json'))
+            # pbsnodes can take a long time on big clusters, reuse recent output like we do for qstat. Stream the
+            # nodes, only the attributes we copy out of each element are kept.
+            for nodeele in iter_xml(cache_cmd(['pbsnodes', '-x'], ignore_cache=not self.cached), 'Node'):
+                self.nodes.append(Node(dict((attr.tag, attr.text) for attr in nodeele)))
+        except (CommandError, ParseError):  # No XML output option (PBS Pro) or broken XML, use JSON output instead
+            self.nodes = []
+            nodes_json = json.loads(cache_cmd(['pbsnodes', '-a', '-F', 'json'], ignore_cache=not self.cached))
             for node_id, node_data in nodes_json['nodes'].items():
                 node_data['name'] = node_id
                 node_data['np'] = node_data['resources_available'].get('ncpus', '0')  # 1 to prevent division by 0
@@ -354,9 +462,58 @@ class Cluster:
     def filter_node_states(self, states):
         self.nodes = list(filter(lambda x: not states.difference(x.state_set), self.nodes))
 
+    def get_job(self, job_id):
+        """ Get job by its ID, add an empty one if we haven't seen it yet
+
+        :param job_id: Job ID
+        :type job_id: str
+        :return: Job with this ID
+        :rtype: Job
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            job = self.jobs[job_id] = Job()
+        return job
+
     def jobs_list(self):
-        return sorted(self.jobs.values(), key=lambda x: x.job_id, reverse=True)
+        return sorted(self.jobs.values(), key=attrgetter('job_id'), reverse=True)
 
 
 def list_node_names():
     return [n.raw['name'] for n in Cluster(nodes=True).nodes]
+
+
+def read_pbs_output_file(path):
+    """ Read the "==> param: value" header lines from a job output file
+
+    :param path: Job output file path
+    :type path: str
+    :return: param -> value pairs, "Resources used" and "Job config" are split into separate keys
+    :rtype: dict
+    """
+    headers = {}
+
+    # Read as bytes, job output can be large and we only need to decode the header lines. Small files are read at
+    # once, unbuffered read() sizes a single read from fstat. Big ones are mapped so the job output isn't copied.
+    with open(path, 'rb', 0) as fin:
+        if os.fstat(fin.fileno()).st_size > PBS_OUTPUT_MMAP_SIZE:
+            data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = fin.read()
+
+    # Parse only useful details, ignore job output for now. Lines without a colon are job output that just
+    # looks like our header, ie: tail's "==> file <=="
+    try:
+        for param, val in RE_PBS_HEADER.findall(data):
+            param = param.decode('utf-8', 'replace').strip()
+            val = val.decode('utf-8', 'replace').strip()
+
+            if param in ('Resources used', 'Job config'):
+                headers.update(RE_PBS_RESOURCE.findall(val))
+            else:
+                headers[param] = val
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+    return headers
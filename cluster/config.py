@@ -1,36 +1,34 @@
 import os
 import re
-import subprocess
 
 USER = os.getenv("USER")
 HOME = os.getenv("HOME")
 PATH = os.getenv('PATH')
-CWD = os.getcwd()
 
 USER_LABEL = '*%s' % (USER,)
 
 LOG_PATH = os.path.join(HOME, '.pbs_log')
 PBS_OUTPUT = os.path.join(HOME, 'pbs-output')
 PBS_ARCHIVE_PATH = os.path.join(PBS_OUTPUT, 'archive')
+PBS_OUTPUT_CACHE = os.path.join(HOME, '.pbs_output_cache')  # Parsed job output headers, see read_pbs_output
+PBS_OUTPUT_WORKERS = min(32, (os.cpu_count() or 1) * 4)  # Threads reading uncached job output files
+PBS_OUTPUT_MMAP_SIZE = 1 << 20  # Job output files bigger than this are mapped instead of read
+SUBMIT_WORKERS = 8  # Concurrent qsub processes in submit_jobs
+SUBMIT_RATE = 20  # Max qsub calls per second in submit_jobs, protects the PBS server from bursts
 
 SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
 JOB_TEMPLATE = os.path.join(SCRIPT_PATH, 'qsub_job.template')
 
-# Get terminal width for nicer printing
-WIDTH = os.getenv("COLUMNS")
+WIDTH = 120  # Default terminal width, ie: called remotely via pssh or similar
 
-if not WIDTH:
-    try:
-        stty_size = subprocess.check_output(['stty', 'size'], stderr=subprocess.STDOUT)
-        _, WIDTH = map(int, stty_size.decode().split())
-    except subprocess.CalledProcessError:
-        WIDTH = 120  # Default width, ie: called remotely via pssh or similar
-
-# Some useful constants, python 2.6 compatible
-UP_STATES = set(("job-exclusive", "job-sharing", "reserve", "free", "busy", "time-shared"))
+# Some useful constants
+UP_STATES = {"job-exclusive", "job-sharing", "reserve", "free", "busy", "time-shared"}
 
 RE_JOB = re.compile(r'(\d+/)?(\d+)[.].+')
 RE_DC = re.compile(r'(.+)[.]o(\d+)')
+RE_PBS_HEADER = re.compile(br'^==>([^:\n]*):(.*)$', re.M)  # ie: ==> Exit status    : 0
+RE_PBS_RESOURCE = re.compile(r'([^,=\s]+)=([^,]*)')  # ie: cput=00:00:01,mem=0kb,vmem=0kb
+RE_PBS_LOG = re.compile(r'^[ \t]*\[([^\]]*)\][ \t]+(\S+)[ \t]+(.*?)[ \t\r]*$', re.M)  # ie: [isoformat]\tjob_id\t"cmd"
 
 # Adapted from: https://stackoverflow.com/a/14693789
 ANSI_ESC = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
@@ -17,16 +17,20 @@ def main():
         description='Deletes all queued and running jobs.')
     _ = parser.parse_args()
 
-    qstat = run_cmd('/usr/bin/qstat -u %s' % USER)
+    qstat = run_cmd(['/usr/bin/qstat', '-u', USER])
     jobs = re.findall(r'^(\d+)[.]', qstat, flags=re.M)
 
+    if not jobs:
+        print("You have no queued or running jobs.")
+        return
+
     if not query_yes_no("Are you really sure you want to delete all your jobs (%d)?" % len(jobs), default="no"):
         print("No jobs were deleted.")
         return
 
     print("Deleting jobs: %s" % ' '.join(jobs))
 
-    _ = run_cmd('qdel %s' % ' '.join(jobs))
+    _ = run_cmd(['qdel'] + jobs)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,23 @@
 #!/usr/bin/env python
 import operator
 import os
-import random
 import re
 import sys
-from collections import defaultdict
+from collections import Counter
 from datetime import datetime
-from subprocess import Popen, PIPE
-from tarfile import TarFile
 
 from cluster.common import Cluster
 from cluster.config import USER, LOG_PATH, USER_LABEL, PBS_ARCHIVE_PATH, HOME
-from cluster.tools import confirm_delete, parse_timearg, truncate_str, cache_cmd, print_table
+from cluster.tools import confirm_delete, parse_timearg, truncate_str, cache_cmd, print_table, open_tar_gz, \
+    run_cmd
+
+# Row format of the job summary printed by print_all_jobs
+SUMMARY_ROW = "%-15s %-10s %-10s %-10s %-10s"
+
+# Accepted TimeDelta formats
+RE_DATE = re.compile(r'\d{4}-\d{2}-\d{2}\Z')
+RE_JOB_ID = re.compile(r'(\d+)[a-cn-u.]*(?:-+(\d*)[a-cn-u.]*)?\Z')  # ie: 100, 100.pbs, 100-200
+RE_TIMEARG = re.compile(r'\d+[hdw]\Z')
 
 
 class TimeDeltaError(Exception):
@@ -24,45 +30,64 @@ class TimeDelta:
     def __init__(self, arg, newer=True):
         self.compare = operator.ge if newer else operator.le
 
-        if re.match(r'^\d{4}-\d{2}-\d{2}$', arg):
+        self.value_max = None
+
+        if arg.isdigit():  # Plain job id, the most common limit
+            self.field = 'job_id'
+            self.value_min = int(arg)
+        elif arg[-1:] in ('h', 'd', 'w') and RE_TIMEARG.match(arg):  # Only time periods end with a unit
+            self.field = 'date'
+            self.value = parse_timearg(arg)
+        elif RE_DATE.match(arg):
             self.field = 'date'
             self.value = datetime.strptime(arg, '%Y-%m-%d')
-        elif re.match(r'^\d+[a-cn-u.]*-*\d*[a-cn-u.]*$', arg):
+        elif RE_JOB_ID.match(arg):
             self.field = 'job_id'
-            if '-' in arg:
-                self.value_min = int(arg.split('-')[0].split('.')[0])
-                self.value_max = int(arg.split('-')[1].split('.')[0])
-            else:
-                self.value_min = int(arg.split('.')[0])
+            low, high = RE_JOB_ID.match(arg).groups()
+            self.value_min = int(low)
+            if high:  # Range, ie: 100-200
+                self.value_max = int(high)
         elif ',' in arg:
             self.compare = operator.contains
             self.field = 'job_id_list'
-            self.value = [int(j) for j in arg.split(',')]
-        elif re.match(r'^\d+[hdw]$', arg):
-            self.field = 'date'
-            self.value = parse_timearg(arg)
+            self.value = set(int(j) for j in arg.split(','))
         else:
             raise TimeDeltaError("Unable to parse: %s" % arg)
 
     def filter(self, jobs):
+        """Filter jobs matching the constraint
+
+        :param jobs: Jobs sorted by job_id from newest to oldest, as returned by Cluster.jobs_list
+        :type jobs: list[Job]
+        :return: matching jobs
+        :rtype: list[Job]
+        """
+        # Pick the field specific filter once instead of checking the field for every job
+        return list(getattr(self, 'filter_%s' % self.field)(jobs))
+
+    def filter_date(self, jobs):
         for job in jobs:
-            if self.field == 'date':
-                if job.finished:
-                    if self.compare(job.finished, self.value):
-                        yield job
-                elif not job.qstat and job.start_time:
-                    if self.compare(job.start_time, self.value):
-                        yield job
-            if self.field == 'job_id_list':
-                if self.compare(self.value, job.job_id):
+            if job.finished:
+                if self.compare(job.finished, self.value):
                     yield job
-            elif self.field == 'job_id':
-                if self.compare(job.job_id, self.value_min):
-                    if hasattr(self, 'value_max'):
-                        if not operator.le(job.job_id, self.value_max):
-                            continue
+            elif not job.qstat and job.start_time:
+                if self.compare(job.start_time, self.value):
                     yield job
 
+    def filter_job_id_list(self, jobs):
+        for job in jobs:
+            if self.compare(self.value, job.job_id):
+                yield job
+
+    def filter_job_id(self, jobs):
+        for job in jobs:
+            if self.compare is operator.ge and job.job_id < self.value_min:
+                break  # Only older jobs from here on
+            if self.compare(job.job_id, self.value_min):
+                if self.value_max is not None and job.job_id > self.value_max:
+                    continue
+                yield job
+
 
 def read_qstat():
     """Parses the brief qstat output for all users and makes 3 separate summaries: users, queues, total
@@ -70,22 +95,28 @@ def read_qstat():
     :return: Job summaries for users, queues and total
     :rtype: tuple[dict, dict, dict]
     """
-    qstat = cache_cmd('/usr/bin/qstat')
+    qstat = cache_cmd(['/usr/bin/qstat'])
 
-    user_stats = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-    queue_stats = defaultdict(lambda: defaultdict(int))
-    total_stats = defaultdict(int)
+    counts = Counter()
 
-    for line in qstat.split('\n')[2:]:  # skip first two rows of header
-        if not line:
+    for line in qstat.splitlines()[2:]:  # skip first two rows of header
+        parts = line.split()
+        if len(parts) < 6:  # Blank or malformed row, ie: qstat warnings mixed into the output
             continue
 
-        job_id, name, user, time, status, queue = line.strip().split()
+        job_id, name, user, time, status, queue = parts[:6]
+        counts[(user, queue, status)] += 1
 
+    # Derive all three summaries from the flat counts, one entry per (user, queue, status) combination
+    user_stats = {}
+    queue_stats = {}
+    total_stats = Counter()
+
+    for (user, queue, status), count in counts.items():
         user = USER_LABEL if user == USER else user
-        user_stats[user][queue][status] += 1
-        queue_stats[queue][status] += 1
-        total_stats[status] += 1
+        user_stats.setdefault(user, {}).setdefault(queue, Counter())[status] = count
+        queue_stats.setdefault(queue, Counter())[status] += count
+        total_stats[status] += count
 
     return user_stats, queue_stats, total_stats
 
@@ -94,27 +125,29 @@ def print_all_jobs():
     """Print a short summary of running/queued jobs. Identical to the old jobstatus script."""
     user_stats, queue_stats, total_stats = read_qstat()
 
-    print("=========================================================")
-    print("%-15s %-10s %-10s %-10s %-10s" % ('User', 'Queue', 'Running', 'Queued', 'Exiting'))
-    print("---------------------------------------------------------")
-
-    statuses = ('R', 'Q', 'E')
+    out = [
+        "=========================================================",
+        SUMMARY_ROW % ('User', 'Queue', 'Running', 'Queued', 'Exiting'),
+        "---------------------------------------------------------"
+    ]
 
+    # Stats are Counters, missing statuses count as 0
     for user in sorted(user_stats):
-        for queue in sorted(user_stats[user]):
-            row = tuple([user, queue] + [user_stats[user][queue].get(s, 0) for s in statuses])
-            print("%-15s %-10s %-10s %-10s %-10s" % row)
+        queues = user_stats[user]
+        for queue in sorted(queues):
+            counts = queues[queue]
+            out.append(SUMMARY_ROW % (user, queue, counts['R'], counts['Q'], counts['E']))
 
-    print("---------------------------------------------------------")
+    out.append("---------------------------------------------------------")
 
     for queue in sorted(queue_stats):
-        row = tuple(['', queue] + [queue_stats[queue].get(s, 0) for s in statuses])
-        print("%-15s %-10s %-10s %-10s %-10s" % row)
+        counts = queue_stats[queue]
+        out.append(SUMMARY_ROW % ('', queue, counts['R'], counts['Q'], counts['E']))
 
-    print("                -----------------------------------------")
+    out.append("                -----------------------------------------")
+    out.append(SUMMARY_ROW % ('', 'totals', total_stats['R'], total_stats['Q'], total_stats['E']))
 
-    row = tuple(['', 'totals'] + [total_stats.get(s, 0) for s in statuses])
-    print("%-15s %-10s %-10s %-10s %-10s" % row)
+    sys.stdout.write('\n'.join(out) + '\n')
 
 
 def details(args):
@@ -123,10 +156,6 @@ def details(args):
     :param args: Arguments from argparse
     :type args: argparse.Namespace
     """
-    # Don't cache commands if we're deleting jobs, we need fresh status
-    cluster = Cluster(jobs_qstat=True, jobs_log=True, jobs_pbs=True, cached=not args.delete)
-    jobs = cluster.jobs_list()
-
     filtering = True in (args.print_running, args.print_queued, args.print_completed, args.print_failed)
 
     # We're about to delete some jobs, make sure to sanitize other arguments to make sense with delete action
@@ -154,42 +183,50 @@ def details(args):
             sys.stderr.write('Warning: Filtering by number of jobs (%s) ignored.\n' % args.limit_output)
             args.limit_output = None
 
+    # Parse the limit before loading jobs, limiting by time lets us skip reading old .pbs_log entries
+    limit_check = None
+    if args.limit_output and not (args.limit_output.isdigit() and int(args.limit_output) < 10000):
+        try:
+            limit_check = TimeDelta(args.limit_output)
+        except TimeDeltaError:  # we'll filter by name
+            pass
+
+    log_since = limit_check.value if limit_check and limit_check.field == 'date' else None
+
+    # Don't cache commands if we're deleting jobs, we need fresh status
+    cluster = Cluster(jobs_qstat=True, jobs_log=True, jobs_pbs=True, cached=not args.delete, log_since=log_since)
+    jobs = cluster.jobs_list()
+
     if filtering:
+        # Drop unwanted states in a single pass, jobs are identified by the first letter of their state
+        hidden = set()
         if not args.print_running:
-            jobs = [job for job in jobs if not job.state.startswith('R')]
+            hidden.add('R')
         if not args.print_queued:
-            jobs = [job for job in jobs if not job.state.startswith('Q')]
+            hidden.add('Q')
         if not args.print_completed:
-            jobs = [job for job in jobs if not job.state.startswith('C')]
+            hidden.add('C')
         if not args.print_failed:
-            jobs = [job for job in jobs if not (job.state.startswith('F') or job.state == '?')]
+            hidden.update(('F', '?'))
+        jobs = [job for job in jobs if job.state[:1] not in hidden]
 
     if args.limit_output:
-        if args.limit_output.isdigit():
-            if int(args.limit_output) < 10000:
-                jobs = jobs[:int(args.limit_output)]
-            else:
-                limit_check = TimeDelta(args.limit_output)
-                jobs = limit_check.filter(jobs)
-        else:
-            try:  # filter by time
-                limit_check = TimeDelta(args.limit_output)
-                jobs = limit_check.filter(jobs)
-            except TimeDeltaError:  # try filtering by name
-                jobs = [job for job in jobs if job.name == args.limit_output]
+        if limit_check:
+            jobs = limit_check.filter(jobs)
+        elif args.limit_output.isdigit():
+            jobs = jobs[:int(args.limit_output)]
+        else:  # filter by name
+            jobs = [job for job in jobs if job.name == args.limit_output]
 
     if args.output == 'jobid':
         jobids = [str(job.job_id) for job in jobs]
         print(' '.join(jobids))
     elif args.output == 'cmd':
-        for job in jobs:
-            print(job.cmd)
+        sys.stdout.write(''.join('%s\n' % job.cmd for job in jobs))
     else:
-        data = []
-        for job in jobs:
-            data.append(
-                [str(job.job_id), truncate_str(job.name, 20), job.state, job.exit_status, job.start, job.runtime,
-                 job.memory, job.cmd])
+        # Rows as tuples, print_table formats them as they are
+        data = [(str(job.job_id), truncate_str(job.name, 20), job.state, job.exit_status, job.start, job.runtime,
+                 job.memory, job.cmd) for job in jobs]
 
         print_table(
             ['Job ID', 'Name', 'Status', 'Exit', 'Start Time', 'Elapsed/Total Time', 'Used Memory', 'Command'],
@@ -197,7 +234,6 @@ def details(args):
         )
 
     if args.delete:
-        jobs = list(jobs)
         if not len(jobs):
             print("\n\nNo jobs to delete.")
             return
@@ -205,11 +241,7 @@ def details(args):
         print("\n\nDANGER ZONE!")
         if confirm_delete('Are you sure you want to delete %s jobs listed above?' % len(jobs), str(len(jobs))):
             ids = [str(j.job_id) for j in jobs]
-            proc = Popen('qdel %s' % ' '.join(ids), shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True,
-                         universal_newlines=True)
-            qdel, err = proc.communicate()
-            if err:
-                raise Exception("Can't run qdel: %s" % err)
+            run_cmd(['qdel'] + ids)  # Raises on qdel errors
             print("Deleted %d jobs." % len(ids))
         else:
             print("Wrong answer, not deleting anything.")
@@ -247,10 +279,10 @@ def archive(args):
     if not os.path.exists(PBS_ARCHIVE_PATH):
         os.mkdir(PBS_ARCHIVE_PATH)
 
-    tar_file = '%s_%032x.tar.gz' % (datetime.now().strftime('%Y-%m-%d'), random.getrandbits(128))
+    tar_file = '%s_%s.tar.gz' % (datetime.now().strftime('%Y-%m-%d'), os.urandom(16).hex())
     tar_path = os.path.join(PBS_ARCHIVE_PATH, tar_file)
 
-    with TarFile.open(tar_path, 'w:gz') as tar:
+    with open_tar_gz(tar_path) as tar:
         for job in jobs_to_archive:
             if job.pbs_output:
                 tar.add(job.pbs_output, arcname=job.pbs_output.replace(HOME, '').lstrip('/'))
@@ -262,7 +294,12 @@ def archive(args):
             print('Archived job %s' % job.job_id)
 
     with open(LOG_PATH + '_bkp', 'w') as log:
-        for job in jobs[::-1]:
+        # Lines that don't belong to any job we know of are kept as they are
+        if cluster.pbs_log_other:
+            sys.stderr.write('WARNING: Keeping %d unrecognised lines in %s\n' % (len(cluster.pbs_log_other), LOG_PATH))
+            log.writelines(cluster.pbs_log_other)
+
+        for job in reversed(jobs):  # Oldest first, same order as the original log
             if job.pbs_log and job.job_id not in archived_job_ids:
                 log.write(job.pbs_log)
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-from collections import defaultdict
+from itertools import groupby
+from operator import attrgetter
 
 from cluster.common import Cluster
 from cluster.tools import print_table
@@ -11,7 +12,7 @@ def check_status(args):
     :param args: Arguments from argparse
     :type args: argparse.Namespace
     """
-    cluster = Cluster(jobs_qstat=True, nodes=True, link=True)
+    cluster = Cluster(jobs_qstat=True, nodes=True, link=True, cached=not args.no_cache)
     nodes = []
 
     if args.filter_states:
@@ -33,14 +34,12 @@ def check_status(args):
             nodes[-1][-1] = ''
             empty = [''] * 5
 
-            users = defaultdict(list)
-            for job in node.jobs_qstat:
-                users[job.user].append(job)
-            for orphan in node.orphans:
-                users['ORPHANS'].append(orphan)
+            by_user = attrgetter('user')
+            users = [(u, list(jobs)) for u, jobs in groupby(sorted(node.jobs_qstat, key=by_user), by_user)]
+            if node.orphans:
+                users.append(('ORPHANS', node.orphans))
 
-            for idx, uitem in enumerate(users.items()):
-                u, jobs = uitem
+            for idx, (u, jobs) in enumerate(users):
                 column_data = '%s: %s' % (u, ' '.join([str(j.job_id) for j in jobs]))
 
                 if idx:
@@ -60,6 +59,7 @@ def main():
     parser = argparse.ArgumentParser(description='Check nodes status.')
     parser.add_argument('-o', '--show-job-owners', action='store_true', help='List jobs running on nodes')
     parser.add_argument('-s', '--filter-states', help='Display only nodes in FILTER_STATES (comma separated).')
+    parser.add_argument('-n', '--no-cache', action='store_true', help='Ignore cached pbsnodes and qstat output.')
     args = parser.parse_args()
 
     check_status(args)
@@ -1,13 +1,16 @@
 import os
 import re
-import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from cluster.config import CWD, PBS_OUTPUT, PATH
-from cluster.tools import run_cmd, get_job_template
+from cluster.config import PBS_OUTPUT, PATH, SUBMIT_WORKERS, SUBMIT_RATE
+from cluster.tools import run_cmd, get_job_template, RateLimiter
 
+RE_QUOTED = re.compile("^($|'|\")")
+SHELL_META = frozenset("${[]!} ")
 
-def submit(cmd, walltime=24, mem=2, cpu=1, email=None, wd=CWD, output_dir=PBS_OUTPUT, path=PATH, job_name=None,
+
+def submit(cmd, walltime=24, mem=2, cpu=1, email=None, wd=None, output_dir=PBS_OUTPUT, path=PATH, job_name=None,
            pretend=False, environment=None, conda_profile="/etc/profile.d/conda.sh", node="1", job_template=None):
     """Submits a command to the cluster
 
@@ -44,8 +47,46 @@ def submit(cmd, walltime=24, mem=2, cpu=1, email=None, wd=CWD, output_dir=PBS_OU
     """
 
     # Create output dir if it does not exist yet
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    pbs = job_script(cmd, walltime=walltime, mem=mem, cpu=cpu, email=email, wd=wd, output_dir=output_dir, path=path,
+                     job_name=job_name, environment=environment, conda_profile=conda_profile, node=node,
+                     job_template=job_template)
+
+    if not pretend:
+        return qsub(pbs)
+    else:
+        return cmd
+
+
+def qsub(pbs, after=None):
+    """Submit a PBS job script
+
+    :param pbs: PBS job script
+    :param after: Start the job only after this job finishes successfully
+    :type pbs: str
+    :type after: str
+    :return: Job id returned by qsub.
+    :rtype: str
+    """
+    cmd = ['qsub']
+    if after:
+        cmd += ['-W', 'depend=afterok:%s' % (after,)]
+
+    job_id = run_cmd(cmd, inp=pbs)
+    return job_id.strip()
+
+
+def job_script(cmd, walltime=24, mem=2, cpu=1, email=None, wd=None, output_dir=PBS_OUTPUT, path=PATH, job_name=None,
+               environment=None, conda_profile="/etc/profile.d/conda.sh", node="1", job_template=None):
+    """Fill in the PBS job script for a command, parameters are the same as in submit
+
+    :return: PBS job script to pass to qsub.
+    :rtype: str
+    """
+
+    if not wd:
+        wd = os.getcwd()
 
     walltime_str = '%02d:%02d:00' % (walltime, 60 * (walltime % 1))
     memory = '%dM' % (1024 * mem,)
@@ -63,7 +104,7 @@ def submit(cmd, walltime=24, mem=2, cpu=1, email=None, wd=CWD, output_dir=PBS_OU
         job_name = cmd.split()[0]  # Remove anything following a space (can be introduced during smart quoting)
         job_name = os.path.split(job_name)[-1]  # Remove the path before any command
         job_name = job_name.replace('&', '')  # Remove any ampersands
-        job_name = re.sub(r'^\d+', '', job_name)  # Remove any leading digits, otherwise qsub will throw an error
+        job_name = job_name.lstrip('0123456789')  # Remove any leading digits, otherwise qsub will throw an error
 
     job_setup = ''
     if environment and conda_profile:
@@ -100,27 +141,72 @@ conda activate %s""" % (conda_profile, environment)
         cmd=cmd
     )
 
-    if not pretend:
-        job_id = run_cmd('qsub', inp=pbs)
-        return job_id.strip()
-    else:
-        return cmd
-
+    return pbs
 
-def submit_jobs(commands, job_log, is_pretend, **kwargs):
-    job_template = get_job_template()
 
-    for i, cmd in enumerate(commands):
+def submit_jobs(commands, job_log, is_pretend, max_jobs_per_sec=SUBMIT_RATE, fanout=SUBMIT_WORKERS, chain=False,
+                **kwargs):
+    def report(i, job_id):
         prefix = '' if len(commands) == 1 else ('%d: ' % i)
-
-        job_id = submit(cmd, job_template=job_template, **kwargs)
         print(prefix + job_id)
 
         if job_log:
-            job_log.write('[%s]\t%s\t"%s"\n' % (datetime.now().isoformat(), job_id, cmd))
+            job_log.write('[%s]\t%s\t"%s"\n' % (datetime.now().isoformat(), job_id, commands[i]))
 
-        if not is_pretend:  # we're just printing commands, do it as fast as possible
-            time.sleep(0.1)
+    if is_pretend:  # Nothing is submitted, the job scripts and output folder aren't needed
+        for i, cmd in enumerate(commands):
+            report(i, cmd)
+        return
+
+    kwargs.pop('pretend', None)  # is_pretend decides
+    kwargs['wd'] = kwargs.get('wd') or os.getcwd()  # Same for all jobs, look it up once
+    os.makedirs(kwargs.get('output_dir', PBS_OUTPUT), exist_ok=True)
+
+    # Fill in all job scripts before submitting anything, only the qsub calls themselves run in the pool
+    job_template = get_job_template()
+    scripts = [job_script(cmd, job_template=job_template, **kwargs) for cmd in commands]
+    limiter = RateLimiter(max_jobs_per_sec)
+
+    def submit_one(pbs):
+        limiter.acquire()
+        return qsub(pbs)
+
+    def submit_chain():
+        job_id = None
+        for pbs in scripts:
+            limiter.acquire()
+            job_id = qsub(pbs, after=job_id)
+            yield job_id
+
+    if chain:  # Each job depends on the previous one, its id has to be known before the next qsub
+        for i, job_id in enumerate(submit_chain()):
+            report(i, job_id)
+        return
+
+    # Every qsub is a fork+exec and a server round trip, overlap them instead of submitting one by one. Results are
+    # still printed and logged in the order of commands.
+    with ThreadPoolExecutor(max_workers=fanout) as executor:
+        futures = [executor.submit(submit_one, pbs) for pbs in scripts]
+        reported = 0
+        try:
+            for future in futures:
+                report(reported, future.result())
+                reported += 1
+        except BaseException:
+            # Don't start the rest of the batch after a failed qsub, but report every job that was submitted anyway
+            # by the qsubs already running, so the user can still find them
+            for future in futures[reported:]:
+                future.cancel()
+
+            for i, future in enumerate(futures[reported:], reported):
+                if future.cancelled():
+                    continue
+                try:
+                    job_id = future.result()
+                except Exception:  # The failed qsub
+                    continue
+                report(i, job_id)
+            raise
 
 
 def sanitize_cmd(bit):
@@ -132,9 +218,9 @@ def sanitize_cmd(bit):
     :rtype: str
     """
 
-    if "'" in bit and not re.search("^($|'|\")", bit):
+    if "'" in bit and not RE_QUOTED.match(bit):
         return '"%s"' % (bit,)
-    elif re.search(r"[${[\]!} ]", bit) and "'" not in bit:
+    elif not SHELL_META.isdisjoint(bit) and "'" not in bit:
         return "'%s'" % (bit,)
     elif bit == "awkt":
         return "awk -F '\t' -v OFS='\t'"
@@ -4,7 +4,7 @@ import re
 import sys
 
 from cluster.common import list_node_names
-from cluster.config import HOME
+from cluster.config import HOME, SUBMIT_RATE, SUBMIT_WORKERS
 from cluster.submit import sanitize_cmd, submit_jobs
 from cluster.tools import environment_exists, batch
 
@@ -59,7 +59,7 @@ EXAMPLE #2: submitjob my_command.py -w 12 -m 5
     parser.add_argument('-conda-profile', '--conda-profile',
                         help='Path to conda profile. Used for local conda installations.',
                         default='/etc/profile.d/conda.sh')
-    parser.add_argument('-f', '-file', '--file', type=argparse.FileType('rU'),
+    parser.add_argument('-f', '-file', '--file', type=argparse.FileType('r'),
                         help='Read commands from a file, one per line. If a "command" is specified as a positional '
                              'argument this will be ignored.')
     parser.add_argument('-l', '-disable-log', '--disable-log', action='store_true',
@@ -71,7 +71,7 @@ EXAMPLE #2: submitjob my_command.py -w 12 -m 5
                         help='Send an email to this address when a job ends or is aborted')
     parser.add_argument('-n', '-name', '--name', default=None,
                         help='Give submitted job(s) a verbose name.')
-    parser.add_argument('-a', '-args', '--args', type=argparse.FileType('rU'),
+    parser.add_argument('-a', '-args', '--args', type=argparse.FileType('r'),
                         help='File with a list of arguments to the job for batch submitting. '
                              'Works only with direct command, not -f. '
                              'Batch-size of arguments are appended to the end of command, '
@@ -81,6 +81,15 @@ EXAMPLE #2: submitjob my_command.py -w 12 -m 5
                         help='Number of arguments from <args> to use per job.')
     parser.add_argument('-p', '-pretend', '--pretend', action='store_true',
                         help='Don\'t submit, print the commands out instead.')
+    parser.add_argument('-r', '-max-jobs-per-sec', '--max-jobs-per-sec', type=float, default=SUBMIT_RATE,
+                        help='Submit at most this many jobs per second, default %d.' % SUBMIT_RATE)
+    parser.add_argument('-C', '-chain', '--chain', action='store_true',
+                        help='Run the jobs one after another, each job starts only after the previous one finished '
+                             'successfully.')
+    # noinspection PyTypeChecker
+    parser.add_argument('-F', '-fanout', '--fanout', type=int,
+                        help='Number of qsub calls to run at the same time, default %d. '
+                             'Not available with -C, chained jobs are submitted one by one.' % SUBMIT_WORKERS)
 
     args = parser.parse_args()
 
@@ -101,6 +110,17 @@ EXAMPLE #2: submitjob my_command.py -w 12 -m 5
                 "Trying to use arguments without batch size. "
                 "Please add -b to define how many arguments should be added to command per submitted job.")
 
+    if args.max_jobs_per_sec <= 0:
+        parser.error("Max jobs per second (-r) has to be a positive number")
+
+    if args.fanout is not None:
+        if args.chain:
+            parser.error("Fanout (-F) can't be used with -C, chained jobs are submitted one by one")
+        if args.fanout < 1:
+            parser.error("Fanout (-F) has to be at least 1")
+    else:
+        args.fanout = SUBMIT_WORKERS
+
     # noinspection PyBroadException
     try:
         if args.conda_environment and not environment_exists(args.conda_environment):
@@ -139,12 +159,16 @@ EXAMPLE #2: submitjob my_command.py -w 12 -m 5
             if '{}' not in cmd:
                 cmd.append('{}')  # add the args placeholder to the end for appending
 
-            cmd_args = [arg_fragment.strip() for arg_fragment in args.args]
+            cmd_args = (arg_fragment.strip() for arg_fragment in args.args)
+
+            # The command around the placeholder is the same for every job, sanitize it only once
+            insert_idx = cmd.index('{}')
+            cmd_prefix = ' '.join(map(sanitize_cmd, cmd[:insert_idx]))
+            cmd_suffix = ' '.join(map(sanitize_cmd, cmd[insert_idx + 1:]))
 
             for arg_batch in batch(cmd_args, args.batch_size):
-                insert_idx = cmd.index('{}')
-                expanded_cmd = cmd[:insert_idx] + [('"%s"' % b) for b in arg_batch] + cmd[insert_idx + 1:]
-                commands.append(' '.join(map(sanitize_cmd, expanded_cmd)))
+                batch_args = ' '.join([sanitize_cmd('"%s"' % b) for b in arg_batch])
+                commands.append(' '.join([part for part in (cmd_prefix, batch_args, cmd_suffix) if part]))
         else:
             commands.append(' '.join(map(sanitize_cmd, args.command)))
     elif args.file:
@@ -158,6 +182,9 @@ EXAMPLE #2: submitjob my_command.py -w 12 -m 5
         commands,
         args.log_path if not args.disable_log else None,
         args.pretend,
+        max_jobs_per_sec=args.max_jobs_per_sec,
+        fanout=args.fanout,
+        chain=args.chain,
         walltime=args.walltime,
         mem=args.mem,
         cpu=args.cpu,
@@ -1,29 +1,34 @@
 import hashlib
 import os
+import pickle
+import shlex
 import sys
+import time
 import xml.etree.ElementTree as Et
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from string import Template
-from subprocess import PIPE, Popen
+from itertools import islice
+from shutil import get_terminal_size, which
+from string import Template, ascii_letters
+from subprocess import DEVNULL, PIPE, Popen
+from threading import Lock
 
 from cluster.config import ANSI_ESC, WIDTH, USER, JOB_TEMPLATE
 
+# Length of parse_timearg units in seconds
+PERIOD_SECONDS = {'h': 3600, 'd': 86400, 'w': 604800}
 
-def get_input():
-    """ Get input function for current python version
+# generic_to_gb unit divisors, PBS Pro also allows words (w, kw, mw, ...) which are 8 bytes each
+GB_DIVISORS = {'b': 1073741824., 'kb': 1048576., 'mb': 1024., 'gb': 1., 'tb': 1. / 1024, 'pb': 1. / 1048576}
+WORD_BYTES = 8
 
-    :return: appropriate input function
-    :rtype: typing.Callable
-    """
-    input_func = input
-    if '__builtin__' in sys.modules:  # if we're using python2, fallback to raw_input
-        # noinspection PyUnresolvedReferences
-        input_func = sys.modules['__builtin__'].raw_input
-    return input_func
+
+class CommandError(Exception):
+    """Custom error thrown when an external command reports an error"""
 
 
 def query_yes_no(question, default="yes"):
-    """Ask a yes/no question via raw_input() and return their answer.
+    """Ask a yes/no question via input() and return their answer.
 
     "question" is a string that is presented to the user.
     "default" is the presumed answer if the user just hits <Enter>.
@@ -34,8 +39,6 @@ def query_yes_no(question, default="yes"):
     Code adapted from: https://stackoverflow.com/a/3041990
     """
 
-    input_func = get_input()
-
     valid = {"yes": True, "y": True, "ye": True,
              "no": False, "n": False}
     if default is None:
@@ -49,7 +52,7 @@ def query_yes_no(question, default="yes"):
 
     while True:
         sys.stdout.write(question + prompt)
-        choice = input_func().lower()
+        choice = input().lower()
         if default is not None and choice == '':
             return valid[default]
         elif choice in valid:
@@ -60,7 +63,7 @@ def query_yes_no(question, default="yes"):
 
 
 def confirm_delete(question, confirmation_string):
-    """Ask a question via raw_input() with a string the user must repeat to confirm.
+    """Ask a question via input() with a string the user must repeat to confirm.
     Code adapted from: https://stackoverflow.com/a/3041990
 
     :param question: Question to show
@@ -70,88 +73,207 @@ def confirm_delete(question, confirmation_string):
     :return: Conformation
     :rtype: bool
     """
-    input_func = get_input()
-
     prompt = "\nConfirm by typing in the number of jobs to be deleted: "
 
     while True:
         sys.stdout.write(question + prompt)
-        choice = input_func().lower()
+        choice = input().lower()
         return choice == confirmation_string
 
 
 def run_cmd(cmd, inp=None):
     """ Run command using subprocess lib
 
-    :param cmd: Command to run
+    :param cmd: Command to run, either as a command line or an argument list
     :param inp: Optional input to stdin
-    :type cmd: str
+    :type cmd: str|list[str]
     :type inp: str
     :return: stdout of executed command
     :rtype: str
     """
-    proc = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True)
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)  # Execute directly, spawning a shell just to run one command is wasteful
+
+    # Commands without input get /dev/null, no need for a pipe nobody writes to
+    stdin = PIPE if inp is not None else DEVNULL
+    proc = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True)
     out, err = proc.communicate(input=inp)
     if err:
-        raise Exception("Error running command: %s" % err)
+        raise CommandError("Error running command: %s" % err)
+
+    if '\x1b' in out:  # Strip terminal colors, most commands don't print any
+        out = ANSI_ESC.sub('', out)
+
+    return out
+
+
+def cache_file(cmd):
+    """ Path of the file caching output of the command
 
-    return ANSI_ESC.sub('', out)
+    :param cmd: Command, either as a command line or an argument list
+    :type cmd: str|list[str]
+    :return: cache file path
+    :rtype: str
+    """
+    cmd_line = cmd if isinstance(cmd, str) else ' '.join(cmd)
+    hsh = hashlib.sha1(cmd_line.encode()).hexdigest()
+    return os.path.join('/tmp', '{user}-{hash}'.format(user=USER, hash=hsh))
+
+
+def read_cached_cmd(cmd, max_seconds=60):
+    """ Cached output of the command, None if it was not cached or is older than max_seconds
+
+    :param cmd: Command, either as a command line or an argument list
+    :param max_seconds: How many seconds should the output be cached
+    :type cmd: str|list[str]
+    :type max_seconds: int
+    :return: cached cmd output
+    :rtype: str|None
+    """
+    cached_file = cache_file(cmd)
+
+    try:
+        age = time.time() - os.stat(cached_file).st_mtime  # One stat tells us both if it exists and how old it is
+    except OSError:  # Not cached yet
+        return None
+
+    if age >= max_seconds:
+        return None
+
+    with open(cached_file) as cached_in:
+        return cached_in.read()
 
 
 def cache_cmd(cmd, max_seconds=60, ignore_cache=False):
     """ Run and cache the command for 1min
 
-    :param cmd: Command to execute
+    :param cmd: Command to execute, either as a command line or an argument list
     :param max_seconds: How many seconds should the output be cached
     :param ignore_cache: Ignore cached output, re-run the command
-    :type cmd: str
+    :type cmd: str|list[str]
     :type max_seconds: int
     :type ignore_cache: bool
     :return: cmd output
     :rtype: str
     """
 
-    hsh = hashlib.sha1(cmd.encode()).hexdigest()
-    cached_file = os.path.join('/tmp', '{user}-{hash}'.format(user=USER, hash=hsh))
-    now = datetime.now()
-
-    if not ignore_cache and os.path.exists(cached_file):
-        age = now - datetime.fromtimestamp(os.path.getmtime(cached_file))
-        if age.total_seconds() < max_seconds:
-            with open(cached_file) as cached_in:
-                return cached_in.read()
+    if not ignore_cache:
+        ret = read_cached_cmd(cmd, max_seconds)
+        if ret is not None:
+            return ret
 
     ret = run_cmd(cmd)
 
-    with open(cached_file, 'w') as cached_out:
+    # /tmp is shared, keep the output readable only by the user
+    fd = os.open(cache_file(cmd), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)  # Files cached by older versions were created with default permissions
+    with os.fdopen(fd, 'w') as cached_out:
         cached_out.write(ret)
 
     return ret
 
 
-def parse_xml(xml_string):
-    """ Small convenient method that can handle empty string xml
+def read_pickle(path, default=None):
+    """ Load a pickled object, return default if the file is missing or unreadable
+
+    :param path: Pickle file path
+    :param default: Value returned if the pickle can't be loaded
+    :type path: str
+    :return: unpickled object
+    """
+    try:
+        with open(path, 'rb') as fin:
+            return pickle.load(fin)
+    except Exception:  # Missing, truncated or written by an incompatible version, rebuild it
+        return default
+
+
+def write_pickle(path, obj):
+    """ Pickle the object to path, ignore failures as the pickle is only a cache
+
+    :param path: Pickle file path
+    :param obj: Object to pickle
+    :type path: str
+    """
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as fout:
+            pickle.dump(obj, fout, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)  # Atomic, concurrent jobstatus calls never read a partial file
+    except (IOError, OSError):
+        pass
+
+
+@contextmanager
+def open_tar_gz(path):
+    """ Open a gzipped tar archive for writing. Compress with pigz on all cores when it's installed, gzip module is
+    single threaded and slow for big job outputs.
+
+    :param path: Archive path
+    :type path: str
+    :return: Tar archive open for writing
+    :rtype: typing.Iterator[tarfile.TarFile]
+    """
+    # Only archiving needs tarfile (and the compression modules it pulls in), keep it out of every other command
+    from tarfile import TarFile
+
+    pigz = which('pigz')
+    if pigz is None:
+        with TarFile.open(path, 'w:gz') as tar:
+            yield tar
+        return
+
+    with open(path, 'wb') as fout:
+        proc = Popen([pigz, '-c'], stdin=PIPE, stdout=fout, close_fds=True)
+        try:
+            with TarFile.open(fileobj=proc.stdin, mode='w|') as tar:  # Stream, pipes can't seek
+                yield tar
+        finally:
+            proc.stdin.close()
+            returncode = proc.wait()
+
+    if returncode:
+        raise Exception("Error compressing %s, pigz exited with %d" % (path, returncode))
+
+
+def iter_xml(xml_string, tag, chunk_size=65536):
+    """ Parse the XML incrementally and yield root children with the tag as they are completed. Yielded elements are
+    cleared and dropped from the tree afterwards, the whole document is never held in memory as a tree.
 
     :param xml_string: string form on XML to parse
+    :param tag: Tag of the root children to yield
+    :param chunk_size: How many characters to feed the parser at once
     :type xml_string: str
-    :return: Parsed XML
-    :rtype: Et.Element
+    :type tag: str
+    :type chunk_size: int
+    :return: Root children elements
+    :rtype: typing.Iterator[Et.Element]
     """
-    if not xml_string:
-        return []
+    if not xml_string:  # No jobs, qstat prints nothing
+        return
 
-    return Et.fromstring(xml_string)
+    parser = Et.XMLPullParser(events=('start', 'end'))
+    root = None
+    depth = 0
 
+    for start in range(0, len(xml_string), chunk_size):
+        parser.feed(xml_string[start:start + chunk_size])
 
-def read_xml(cmd):
-    """ Execute cmd and parse the output XML
+        for event, element in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
 
-    :param cmd: Command to run
-    :type cmd: str
-    :return: List of children elements in xml root
-    :rtype: list[Et.Element]
-    """
-    return parse_xml(run_cmd(cmd))
+            depth -= 1
+            # Only direct children of the root, elements with the same tag can be nested deeper in them
+            if depth == 1 and element.tag == tag:
+                yield element
+                element.clear()
+                root.remove(element)
+
+    parser.close()
 
 
 def print_table(headers, data):
@@ -167,53 +289,163 @@ def print_table(headers, data):
 
     # Pad last column with leftover space
     out_len = ' | '.join(columns[:-1]) % tuple(headers[:-1])
-    free_space = max(32, WIDTH - 3 - len(out_len))
+    free_space = max(32, get_terminal_size((WIDTH, 24)).columns - 3 - len(out_len))
     columns[-1] = '%%-%ds' % free_space
     columns_format = ' | '.join(columns)
     header = columns_format % tuple(headers)
 
-    print(header)
-    print('=' * len(header))
+    # Write the whole table at once, much faster than a print per row for long tables
+    lines = [header, '=' * len(header)]
+    lines.extend(columns_format % tuple(node) for node in data)
+    sys.stdout.write('\n'.join(lines) + '\n')
 
-    for node in data:
-        print(columns_format % tuple(node))
 
-
-def environment_exists(env_name):
-    """Checks if conda environment exists. Throws SubmitException if conda is not available.
+def environment_exists(env_name, max_seconds=600):
+    """Checks if conda environment exists. Raises OSError if conda is not installed and CommandError if
+    `conda env list` fails.
 
     :param env_name: Conda environment name
+    :param max_seconds: How long to reuse the environment list, conda is slow to start
     :type env_name: str
+    :type max_seconds: int
     :return: Environment exists
     :rtype: bool
     """
-    ret = run_cmd('conda env list')
+    cmd = ['conda', 'env', 'list']
+
+    ret = read_cached_cmd(cmd, max_seconds)
+    if ret is None or env_name not in conda_environments(ret):
+        # Environment might be new, only trust a fresh list before giving up
+        ret = cache_cmd(cmd, ignore_cache=True)
+
+    return env_name in conda_environments(ret)
 
+
+def conda_environments(env_list):
+    """ Parse environment names from `conda env list` output
+
+    :param env_list: `conda env list` output
+    :type env_list: str
+    :return: Environment names
+    :rtype: set[str]
+    """
     environments = set()
-    for line in ret.splitlines():
+    for line in env_list.splitlines():
         if line and not line.startswith('#'):
             environments.add(line.split()[0])
 
-    return env_name in environments
+    return environments
 
 
 def batch(iterable, n=1):
-    """ Adapted from https://stackoverflow.com/a/8290508
+    """ Split an iterable into lists of n items, the last one can be shorter. The input is consumed lazily, a long
+    arguments file doesn't have to be read in memory first.
 
     :param iterable: iterable we want to split
     :param n: size of a batch
-    :type iterable: [list|tuple]
+    :type iterable: typing.Iterable
     :type n: int
     :return: Input interable split into batches
-    :rtype: [list|tuple]
+    :rtype: typing.Iterator[list]
+    """
+    it = iter(iterable)
+    chunk = list(islice(it, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, n))
+
+
+class RateLimiter:
+    """Spaces out calls evenly to at most `rate` per second, shared by all threads calling acquire"""
+
+    def __init__(self, rate):
+        """
+        :param rate: Max number of calls per second
+        :type rate: float
+        """
+        self.interval = 1. / rate
+        self.next_time = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        """ Sleep only as long as needed to keep the rate, the first calls don't wait at all
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(self.next_time, now) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+def finditer_lines(regex, text):
+    """ Like regex.finditer over a multiline text, but also return the lines between the matches, so lines the regex
+    doesn't recognise aren't skipped silently.
+
+    :param regex: Compiled multiline regex matching whole lines
+    :param text: Text to scan
+    :type regex: typing.Pattern
+    :type text: str
+    :return: (match, None) for matched lines, (None, line) for the rest, in the order of text
+    :rtype: collections.Iterable[tuple]
     """
+    pos = 0
+    for match in regex.finditer(text):
+        for line in text[pos:match.start()].splitlines():
+            yield None, line
+        yield match, None
+        pos = match.end() + 1  # Skip the newline after the match
 
-    size = len(iterable)
-    for ndx in range(0, size, n):
-        yield iterable[ndx:min(ndx + n, size)]
+    for line in text[pos:].splitlines():
+        yield None, line
 
 
-def parse_timearg(arg, since=datetime.now()):
+def reversed_lines(path, block_size=65536):
+    """ Iterate over lines of a file from the last one to the first, reading the file backwards in blocks. Useful to
+    get the latest entries of a long log without reading all of it.
+
+    :param path: Path to the file
+    :param block_size: How many bytes to read at once
+    :type path: str
+    :type block_size: int
+    :return: Lines of the file in reversed order, without line endings
+    :rtype: collections.Iterable[str]
+    """
+    with open(path, 'rb') as fin:
+        fin.seek(0, os.SEEK_END)
+        pos = fin.tell()
+        head = b''
+
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            fin.seek(pos)
+
+            lines = (fin.read(step) + head).split(b'\n')
+            head = lines.pop(0)  # First line might continue in the previous block
+
+            for line in reversed(lines):
+                yield line.decode('utf-8', 'replace')
+
+        yield head.decode('utf-8', 'replace')
+
+
+def parse_isoformat(timestamp):
+    """Parse a timestamp as written by datetime.isoformat(). Slicing the fixed-width fields is much faster than
+    datetime.strptime, which matters for long job logs.
+
+    :param timestamp: Timestamp in YYYY-MM-DDTHH:MM:SS[.ffffff] format
+    :type timestamp: str
+    :return: Parsed timestamp
+    :rtype: datetime
+    """
+    return datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                    int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+                    int(timestamp[20:26].ljust(6, '0')))
+
+
+def parse_timearg(arg, since=None):
     """Parse a human readable timedelta option: 5h,3w,2d,... and subtracts it from the date
 
     :param arg: timedelta string to parse
@@ -223,25 +455,29 @@ def parse_timearg(arg, since=datetime.now()):
     :return: Adjusted datetime
     :rtype: datetime
     """
-    amount = int(arg[:-1])
-    period = arg[-1]
+    if since is None:  # A datetime.now() default would be evaluated only once, at import time
+        since = datetime.now()
 
-    return since - timedelta(
-        **{{'h': 'hours', 'd': 'days', 'w': 'weeks'}[period]: amount}
-    )
+    return since - timedelta(seconds=int(arg[:-1]) * PERIOD_SECONDS[arg[-1]])
 
 
 def generic_to_gb(val):
-    """Convert any random unit to GB
+    """Convert any random unit to GB. Values without a unit or with an unknown one are taken as bytes.
 
-    :param val: size in any unit (including two letter unit)
+    :param val: size in any unit (b, kb, ..., pb or w, kw, ..., pw)
     :type val: str
     :return: size in GB
     :rtype: float
     """
-    unit = val[-2:].lower()
-    val = int(val[:-2])
-    return val / {'kb': 1048576., 'mb': 1024., 'gb': 1.}[unit]
+    number = val.rstrip(ascii_letters)
+    unit = val[len(number):].lower()
+
+    size = int(number)
+    if unit.endswith('w'):
+        size *= WORD_BYTES
+        unit = unit[:-1] + 'b'
+
+    return size / GB_DIVISORS.get(unit, GB_DIVISORS['b'])
 
 
 def truncate_str(s, length=32):
@@ -28,6 +28,7 @@ setup(
     author_email='m.usaj@utoronto.ca',
     package_data={'': ['cluster/qsub_job.template']},
     include_package_data=True,
+    python_requires='>=3.5',
     url='https://github.com/BooneAndrewsLab/cluster-scripts',
     download_url='https://github.com/BooneAndrewsLab/cluster-scripts/archive/master.zip',
 
@@ -39,10 +40,8 @@ setup(
 
         'License :: OSI Approved :: MIT License',
 
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',